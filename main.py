@@ -1,6 +1,11 @@
+import hashlib
+import io
+
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
+import plotly.graph_objects as go
 
 # =========================
 # Page
@@ -14,45 +19,170 @@ uploaded = st.file_uploader("Excelローデータ(.xlsx)をアップロード",
 # Helpers
 # =========================
 def is_binary_like(s: pd.Series) -> bool:
-    x = s.dropna()
-    if len(x) == 0:
-        return False
-    vals = set(pd.to_numeric(x, errors="coerce").dropna().unique().tolist())
-    return vals.issubset({0, 1})
+    if pd.api.types.is_bool_dtype(s.dtype):
+        return bool(s.notna().any())
+    if not pd.api.types.is_numeric_dtype(s.dtype):
+        s = pd.to_numeric(s, errors="coerce")
+    arr = s.to_numpy(dtype=np.float64, na_value=np.nan)
+    arr = arr[~np.isnan(arr)]
+    # 数値が1つもない列（テキストのみ等）はMA扱いしない
+    return bool(arr.size > 0 and np.all((arr == 0) | (arr == 1)))
 
 def split_ma_group(col: str):
     # "質問 - 選択肢" を想定
-    if " - " in col:
-        q, opt = col.split(" - ", 1)
+    q, sep, opt = col.partition(" - ")
+    if sep:
         return q.strip(), opt.strip()
     return None, None
 
-def build_ma_groups(df: pd.DataFrame):
+def binary_like_columns(df: pd.DataFrame, cols: list) -> dict:
+    # 数値列はまとめて1つの行列にして、0/1判定を列方向に一括で行う
+    num_cols = [
+        c for c in cols
+        if pd.api.types.is_numeric_dtype(df[c].dtype) and not pd.api.types.is_bool_dtype(df[c].dtype)
+    ]
+    result = {}
+    if num_cols:
+        mat = df[num_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+        nan = np.isnan(mat)
+        ok = np.all(nan | (mat == 0) | (mat == 1), axis=0) & ~np.all(nan, axis=0)
+        result.update(zip(num_cols, ok.tolist()))
+    # 文字列混じり・bool列などは列ごとに判定
+    for c in cols:
+        if c not in result:
+            result[c] = is_binary_like(df[c])
+    return result
+
+def build_ma_groups(df: pd.DataFrame, parsed: dict):
+    candidates = [c for c, (q, opt) in parsed.items() if q and opt]
+    binary = binary_like_columns(df, candidates)
     groups = {}
-    for c in df.columns:
-        q, opt = split_ma_group(c)
-        if q and opt and is_binary_like(df[c]):
-            groups.setdefault(q, []).append(c)
+    for c in candidates:
+        if binary[c]:
+            groups.setdefault(parsed[c][0], []).append(c)
     # 2列以上のみをMAとして扱う
     return {q: cols for q, cols in groups.items() if len(cols) >= 2}
 
-def shorten_label(s: str, max_len: int) -> str:
-    s = str(s)
-    if len(s) <= max_len:
-        return s
-    return s[: max_len - 1] + "…"
+def compute_schema(df: pd.DataFrame):
+    parsed = {c: split_ma_group(c) for c in df.columns}
+    ma_groups = build_ma_groups(df, parsed)
+    ma_option_cols = set([c for cols in ma_groups.values() for c in cols])
+    sa_cols = [c for c in df.columns if c not in ma_option_cols]
+    ma_option_names = {q: [parsed[c][1] for c in cols] for q, cols in ma_groups.items()}
+    return ma_groups, ma_option_cols, sa_cols, ma_option_names
+
+def to_categorical(df: pd.DataFrame, sa_cols: list) -> pd.DataFrame:
+    # SA列をcategoryにしてvalue_counts/crosstabを整数コードで処理させる
+    # 自由記述などユニーク値が多すぎる列はそのまま
+    # 数値や数値・文字列混在の列は、"無回答"を足すとArrowに変換できない混在カテゴリになるので対象外
+    for c in sa_cols:
+        if pd.api.types.infer_dtype(df[c], skipna=True) != "string":
+            continue
+        if df[c].nunique(dropna=True) <= 0.5 * len(df):
+            df[c] = df[c].astype("category")
+    return df
+
+# file_keyをキーにするキャッシュはload_surveyと同様に上限を付け、長時間稼働でも増え続けないようにする
+@st.cache_data(show_spinner=False, max_entries=8)
+def preview(file_key: str, _df: pd.DataFrame, n_rows: int = 50) -> pd.DataFrame:
+    return _df.head(n_rows)
+
+def build_ma_matrix(df: pd.DataFrame, ma_groups: dict):
+    # MA選択肢列(0/1)をまとめて1つのbool行列にする（float64の1/8のサイズ）
+    # 列は設問ごとに連続して並ぶので、設問→列範囲をsliceで持てる
+    ma_cols = [c for cols in ma_groups.values() for c in cols]
+    mat = df[ma_cols].apply(pd.to_numeric, errors="coerce").fillna(0).to_numpy(dtype=bool)
+    slices = {}
+    start = 0
+    for q, cols in ma_groups.items():
+        slices[q] = slice(start, start + len(cols))
+        start += len(cols)
+    return mat, {c: j for j, c in enumerate(ma_cols)}, slices
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def sa_counts(file_key: str, _df: pd.DataFrame, col: str) -> pd.DataFrame:
+    # 設問ごとにキャッシュ（全設問分をまとめると、rerunのたびに全件の復元コストがかかる）
+    return _mk_counts(safe_series(_df[col]))
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def sa_sa_ct(file_key: str, _df: pd.DataFrame, left_q: str, right_q: str) -> pd.DataFrame:
+    # 件数のクロス表だけをキャッシュし、行％/列％はこの結果から割り算で出す
+    left = safe_series(_df[left_q])
+    right = safe_series(_df[right_q])
+    # 片側だけcategoryだと、数値/文字列混在の相手側とMultiIndexの並べ替えで落ちるのでobjectに戻す
+    if isinstance(left.dtype, pd.CategoricalDtype) != isinstance(right.dtype, pd.CategoricalDtype):
+        left, right = left.astype(object), right.astype(object)
+    return pd.crosstab(left, right)
+
+def shorten_series(s: pd.Series, max_len: int) -> pd.Series:
+    s = s.astype(str)
+    return s.where(s.str.len() <= max_len, s.str[: max_len - 1] + "…")
 
 def topn_with_other(df_counts: pd.DataFrame, label_col: str, value_col: str, top_n: int):
     if len(df_counts) <= top_n:
         return df_counts
-    top = df_counts.head(top_n).copy()
-    other_sum = df_counts.iloc[top_n:][value_col].sum()
-    other_row = pd.DataFrame({label_col: ["その他"], value_col: [other_sum]})
-    return pd.concat([top, other_row], ignore_index=True)
+    # 件数の降順に並んでいる前提で、上位N件 + 残りの合計を1回で組み立てる
+    labels = df_counts[label_col].to_numpy(dtype=object)
+    vals = df_counts[value_col].to_numpy()
+    return pd.DataFrame({
+        label_col: np.concatenate([labels[:top_n], ["その他"]]),
+        value_col: np.concatenate([vals[:top_n], [vals[top_n:].sum()]])
+    })
+
+def _bar(labels, values, yaxis_title: str):
+    # px.barのDataFrame整形を挟まず、配列から直接トレースを作る
+    fig = go.Figure(go.Bar(x=labels, y=values, text=values))
+    # px.barと同じく同一ラベルの棒は積み上げる（go.Figureの既定は"group"で重なって隠れる）
+    fig.update_layout(xaxis_title="", yaxis_title=yaxis_title, barmode="relative")
+    return fig
+
+def _pie(labels, values):
+    return go.Figure(go.Pie(labels=labels, values=values, hole=0.35))
 
 def safe_series(s: pd.Series):
+    # Categoricalのfillnaは欠損がなくても埋め値をカテゴリとして検査するので先に抜ける
+    if not s.isna().any():
+        return s
+    if isinstance(s.dtype, pd.CategoricalDtype) and "無回答" not in s.cat.categories:
+        s = s.cat.add_categories("無回答")
     return s.fillna("無回答")
 
+def _mk_counts(s: pd.Series) -> pd.DataFrame:
+    counts = s.value_counts(dropna=False).reset_index()
+    counts.columns = ["回答（原文）", "件数"]
+    counts["割合(%)"] = (counts["件数"] / counts["件数"].sum() * 100).round(1)
+    return counts
+
+def downcast_numeric(df: pd.DataFrame) -> pd.DataFrame:
+    for c in df.select_dtypes(include="integer").columns:
+        df[c] = pd.to_numeric(df[c], downcast="integer")
+    # 空欄のせいでfloatになった整数列（MAの0/1など）だけfloat32にする
+    # 小数を含む列は表示値が変わるのでfloat64のまま
+    for c in df.select_dtypes(include="float").columns:
+        x = df[c].to_numpy()
+        v = x[~np.isnan(x)]
+        if np.all(v == np.round(v)) and (v.size == 0 or np.abs(v).max() < 2 ** 24):
+            df[c] = x.astype(np.float32)
+    return df
+
+def load_xlsx(file_bytes: bytes) -> pd.DataFrame:
+    try:
+        df = pd.read_excel(io.BytesIO(file_bytes), engine="calamine")
+    except (ImportError, ValueError):
+        # python-calamine 未導入、またはpandas<2.2（calamine非対応）時は openpyxl にフォールバック
+        df = pd.read_excel(io.BytesIO(file_bytes), engine="openpyxl")
+    return downcast_numeric(df)
+
+# dfはcache_resourceでセッション間共有される（コピー・ハッシュなし）。
+# 以降のコードはdfを読み取り専用として扱い、絶対に書き換えないこと。
+# 下流のキャッシュ関数もdfは"_df"で受け取り、ファイルのハッシュ値をキーにする。
+@st.cache_resource(show_spinner=False, max_entries=8)
+def load_survey(file_key: str, _file_bytes: bytes):
+    df = load_xlsx(_file_bytes)
+    ma_groups, ma_option_cols, sa_cols, ma_option_names = compute_schema(df)
+    df = to_categorical(df, sa_cols)
+    return df, ma_groups, ma_option_cols, sa_cols, ma_option_names
+
 # =========================
 # Main
 # =========================
@@ -60,12 +190,24 @@ if not uploaded:
     st.info("まずExcelをアップロードしてください。")
     st.stop()
 
-df = pd.read_excel(uploaded)
+file_bytes = uploaded.getvalue()
+file_key = hashlib.md5(file_bytes).hexdigest()[:16]
+df, ma_groups, ma_option_cols, sa_cols, ma_option_names = load_survey(file_key, file_bytes)
 st.success(f"アップロード完了：{df.shape[0]}行 × {df.shape[1]}列")
 
-ma_groups = build_ma_groups(df)
-ma_option_cols = set([c for cols in ma_groups.values() for c in cols])
-sa_cols = [c for c in df.columns if c not in ma_option_cols]
+# MAのbool行列はアップロードごとに1回だけ作ってsession_stateに持つ
+# 全選択肢の選択数もここで1回だけ合計しておく
+if st.session_state.get("ma_mat_key") != file_key:
+    mat, col_idx, slices = build_ma_matrix(df, ma_groups)
+    st.session_state["ma_mat"] = mat
+    st.session_state["ma_col_idx"] = col_idx
+    st.session_state["ma_slices"] = slices
+    st.session_state["ma_sums"] = mat.sum(axis=0).astype(np.int32)
+    st.session_state["ma_mat_key"] = file_key
+ma_mat = st.session_state["ma_mat"]
+ma_col_idx = st.session_state["ma_col_idx"]
+ma_slices = st.session_state["ma_slices"]
+ma_sums = st.session_state["ma_sums"]
 
 # =========================
 # Sidebar (UI)
@@ -81,7 +223,7 @@ st.sidebar.divider()
 show_preview = st.sidebar.checkbox("データプレビューを表示", value=False)
 if show_preview:
     st.subheader("データプレビュー")
-    st.dataframe(df.head(50), use_container_width=True)
+    st.dataframe(preview(file_key, df), use_container_width=True)
 
 # =========================
 # Page 1: Single question charts
@@ -96,16 +238,11 @@ if page == "単純集計（グラフ）":
     if qtype.startswith("SA"):
         # Searchable select
         q = st.selectbox("SA設問を選択", sa_cols)
-        s = safe_series(df[q])
-
-        counts = s.value_counts(dropna=False).reset_index()
-        counts.columns = ["回答（原文）", "件数"]
-        counts["割合(%)"] = (counts["件数"] / counts["件数"].sum() * 100).round(1)
-        counts = counts.sort_values("件数", ascending=False).reset_index(drop=True)
+        counts = sa_counts(file_key, df, q)
 
         # TopN + その他
         counts_top = topn_with_other(counts, "回答（原文）", "件数", top_n)
-        counts_top["回答（表示）"] = counts_top["回答（原文）"].apply(lambda x: shorten_label(x, label_max_len))
+        counts_top["回答（表示）"] = shorten_series(counts_top["回答（原文）"], label_max_len)
 
         left, right = st.columns([1, 1])
 
@@ -116,11 +253,10 @@ if page == "単純集計（グラフ）":
         with right:
             st.write("### グラフ")
             if chart_type == "棒グラフ":
-                fig = px.bar(counts_top, x="回答（表示）", y="件数", text="件数")
-                fig.update_layout(xaxis_title="", yaxis_title="件数")
+                fig = _bar(counts_top["回答（表示）"].to_numpy(), counts_top["件数"].to_numpy(), "件数")
                 st.plotly_chart(fig, use_container_width=True)
             else:
-                fig = px.pie(counts_top, names="回答（表示）", values="件数", hole=0.35)
+                fig = _pie(counts_top["回答（表示）"].to_numpy(), counts_top["件数"].to_numpy())
                 st.plotly_chart(fig, use_container_width=True)
 
     else:
@@ -129,20 +265,19 @@ if page == "単純集計（グラフ）":
             st.stop()
 
         ma_q = st.selectbox("MA設問（グループ）を選択", list(ma_groups.keys()))
-        cols = ma_groups[ma_q]
-
-        sel = df[cols].fillna(0).apply(pd.to_numeric, errors="coerce").fillna(0)
-        option_names = [split_ma_group(c)[1] for c in cols]
+        option_names = ma_option_names[ma_q]
 
+        sums = ma_sums[ma_slices[ma_q]]
+        order = np.argsort(-sums, kind="stable")
         counts = pd.DataFrame({
-            "選択肢（原文）": option_names,
-            "選択数": sel.sum(axis=0).astype(int).values
-        }).sort_values("選択数", ascending=False).reset_index(drop=True)
+            "選択肢（原文）": np.asarray(option_names, dtype=object)[order],
+            "選択数": sums[order]
+        })
 
         counts["割合(%)"] = (counts["選択数"] / len(df) * 100).round(1)
 
         counts_top = topn_with_other(counts, "選択肢（原文）", "選択数", top_n)
-        counts_top["選択肢（表示）"] = counts_top["選択肢（原文）"].apply(lambda x: shorten_label(x, label_max_len))
+        counts_top["選択肢（表示）"] = shorten_series(counts_top["選択肢（原文）"], label_max_len)
 
         left, right = st.columns([1, 1])
 
@@ -153,11 +288,10 @@ if page == "単純集計（グラフ）":
         with right:
             st.write("### グラフ")
             if chart_type == "棒グラフ":
-                fig = px.bar(counts_top, x="選択肢（表示）", y="選択数", text="選択数")
-                fig.update_layout(xaxis_title="", yaxis_title="選択数")
+                fig = _bar(counts_top["選択肢（表示）"].to_numpy(), counts_top["選択数"].to_numpy(), "選択数")
                 st.plotly_chart(fig, use_container_width=True)
             else:
-                fig = px.pie(counts_top, names="選択肢（表示）", values="選択数", hole=0.35)
+                fig = _pie(counts_top["選択肢（表示）"].to_numpy(), counts_top["選択数"].to_numpy())
                 st.plotly_chart(fig, use_container_width=True)
 
 # =========================
@@ -175,22 +309,21 @@ else:
         left_q = st.selectbox("行（基準）SA設問", sa_cols, key="c_sa_sa_left")
         right_q = st.selectbox("列（比較）SA設問", sa_cols, key="c_sa_sa_right")
 
-        left = safe_series(df[left_q])
-        right = safe_series(df[right_q])
-
-        ct = pd.crosstab(left, right)
+        ct = sa_sa_ct(file_key, df, left_q, right_q)
 
-        if metric == "行％（Row%）":
-            view = (ct.div(ct.sum(axis=1), axis=0) * 100).round(1)
-        elif metric == "列％（Col%）":
-            view = (ct.div(ct.sum(axis=0), axis=1) * 100).round(1)
-        else:
+        if metric == "件数":
             view = ct
+        else:
+            arr = ct.to_numpy(dtype=np.float64)
+            denom = arr.sum(axis=1, keepdims=True) if metric == "行％（Row%）" else arr.sum(axis=0, keepdims=True)
+            arr /= np.where(denom == 0, 1, denom)
+            arr *= 100
+            view = pd.DataFrame(np.round(arr, 1, out=arr), index=ct.index, columns=ct.columns)
 
         # 라벨 축약(표는 원문 유지)
         view_display = view.copy()
-        view_display.index = [shorten_label(i, label_max_len) for i in view_display.index]
-        view_display.columns = [shorten_label(c, label_max_len) for c in view_display.columns]
+        view_display.index = pd.Index(shorten_series(pd.Series(view_display.index), label_max_len))
+        view_display.columns = pd.Index(shorten_series(pd.Series(view_display.columns), label_max_len))
 
         c1, c2 = st.columns([1, 1])
 
@@ -200,11 +333,14 @@ else:
 
         with c2:
             st.write("### グラフ（積み上げ棒）")
-            # stacked bar用にlong化
-            long = view.reset_index().melt(id_vars=view.index.name or "index", var_name="列", value_name="値")
-            long.columns = ["行", "列", "値"]
-            long["行"] = long["行"].apply(lambda x: shorten_label(x, label_max_len))
-            long["列"] = long["列"].apply(lambda x: shorten_label(x, label_max_len))
+            # stacked bar用にlong化（ラベルはview_displayで短縮済みのものを使う）
+            row_labels = view_display.index.to_numpy()
+            col_labels = view_display.columns.to_numpy()
+            long = pd.DataFrame({
+                "行": np.repeat(row_labels, len(col_labels)),
+                "列": np.tile(col_labels, len(row_labels)),
+                "値": view.to_numpy().ravel()
+            })
 
             fig = px.bar(long, x="行", y="値", color="列", barmode="stack")
             fig.update_layout(xaxis_title="", yaxis_title=metric)
@@ -220,19 +356,20 @@ else:
 
         ma_q = st.selectbox("列（比較）MA設問（グループ）", list(ma_groups.keys()), key="c_sa_ma_q")
         cols = ma_groups[ma_q]
-        option_names = [split_ma_group(c)[1] for c in cols]
+        option_names = ma_option_names[ma_q]
 
         # 선택할 옵션(=컬럼)을 하나 고르게 해서, 그 옵션을 선택한 사람만의 SA 분포를 보게 함
         opt_pick = st.selectbox("比較したい選択肢（1つ選択）", option_names)
         col_pick = cols[option_names.index(opt_pick)]
 
-        mask = pd.to_numeric(df[col_pick].fillna(0), errors="coerce").fillna(0) == 1
-        base = safe_series(df.loc[mask, left_q])
-
-        counts = base.value_counts(dropna=False).reset_index()
-        counts.columns = ["回答（原文）", "件数"]
+        mask = ma_mat[:, ma_col_idx[col_pick]]
+        vals = safe_series(df[left_q]).to_numpy()[mask]
+        # np.uniqueは数値と文字列が混在すると並べ替えで落ちるため、factorize + bincountで数える
+        codes, uniques = pd.factorize(vals)
+        cnt = np.bincount(codes, minlength=len(uniques))
+        order = np.argsort(-cnt, kind="stable")
+        counts = pd.DataFrame({"回答（原文）": uniques[order], "件数": cnt[order]})
         counts["割合(%)"] = (counts["件数"] / counts["件数"].sum() * 100).round(1)
-        counts = counts.sort_values("件数", ascending=False).reset_index(drop=True)
 
         # 표시 지표 선택 반영
         if metric == "件数":
@@ -243,7 +380,7 @@ else:
             value_col = "割合(%)"
 
         show_df_top = topn_with_other(show_df, "回答（原文）", value_col, top_n)
-        show_df_top["回答（表示）"] = show_df_top["回答（原文）"].apply(lambda x: shorten_label(x, label_max_len))
+        show_df_top["回答（表示）"] = shorten_series(show_df_top["回答（原文）"], label_max_len)
 
         c1, c2 = st.columns([1, 1])
 
@@ -255,9 +392,8 @@ else:
             st.write("### グラフ")
             chart_type = st.radio("グラフ種類", ["棒グラフ", "円グラフ"], horizontal=True, key="sa_ma_chart")
             if chart_type == "棒グラフ":
-                fig = px.bar(show_df_top, x="回答（表示）", y=value_col, text=value_col)
-                fig.update_layout(xaxis_title="", yaxis_title=metric)
+                fig = _bar(show_df_top["回答（表示）"].to_numpy(), show_df_top[value_col].to_numpy(), metric)
                 st.plotly_chart(fig, use_container_width=True)
             else:
-                fig = px.pie(show_df_top, names="回答（表示）", values=value_col, hole=0.35)
+                fig = _pie(show_df_top["回答（表示）"].to_numpy(), show_df_top[value_col].to_numpy())
                 st.plotly_chart(fig, use_container_width=True)
\ No newline at end of file